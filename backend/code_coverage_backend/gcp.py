@@ -18,6 +18,7 @@ from code_coverage_backend.hgmo import hgmo_pushes
 from code_coverage_backend.hgmo import hgmo_revision_details
 from code_coverage_backend.report import DEFAULT_FILTER
 from code_coverage_backend.report import Report
+from code_coverage_tools.gcp import DOWNLOAD_WORKERS
 from code_coverage_tools.gcp import download_report
 from code_coverage_tools.gcp import get_bucket
 from code_coverage_tools.gcp import list_reports
@@ -86,7 +87,12 @@ class GCPCache(object):
         for repo in REPOSITORIES:
             for report in self.list_reports(repo, nb=1):
                 try:
-                    download_report(self.reports_dir, self.bucket, report.name)
+                    download_report(
+                        self.reports_dir,
+                        self.bucket,
+                        report.name,
+                        max_workers=DOWNLOAD_WORKERS,
+                    )
                 except Exception as e:
                     logger.warn(
                         "Failure downloading report {}: {}".format(report.name, e)
@@ -99,7 +105,12 @@ class GCPCache(object):
         )
 
         # Grab the latest zero-cov-report
-        download_report(self.zerocov_dir, self.bucket, "zero_coverage_report")
+        download_report(
+            self.zerocov_dir,
+            self.bucket,
+            "zero_coverage_report",
+            max_workers=DOWNLOAD_WORKERS,
+        )
 
     def ingest_pushes(self, repository, platform, suite, min_push_id=None, nb_pages=3):
         """
@@ -140,7 +151,9 @@ class GCPCache(object):
         When a report exist for a changeset, download it and update redis data
         """
         # Download the report
-        if not download_report(self.reports_dir, self.bucket, report.name):
+        if not download_report(
+            self.reports_dir, self.bucket, report.name, max_workers=DOWNLOAD_WORKERS
+        ):
             logger.info("Report not available", report=str(report))
             return False
 
@@ -384,6 +397,11 @@ class GCPCache(object):
             return
 
         # Load the most recent zero coverage report into cache
-        download_report(self.zerocov_dir, self.bucket, "zero_coverage_report")
+        download_report(
+            self.zerocov_dir,
+            self.bucket,
+            "zero_coverage_report",
+            max_workers=DOWNLOAD_WORKERS,
+        )
 
         self.redis.hset("zero_coverage", "latest-rev", revision)
@@ -87,6 +87,7 @@ def mock_bucket(mock_secrets):
             else:
                 self._content = None
             self._exists = exists
+            self.size = len(self._content) if self._content is not None else None
 
         def exists(self):
             return self._exists
@@ -110,6 +111,9 @@ def mock_bucket(mock_secrets):
                 return self._blobs[name]
             return MockBlob(name)
 
+        def get_blob(self, name):
+            return self._blobs.get(name)
+
     return MockBucket()
 
 
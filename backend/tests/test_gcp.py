@@ -48,6 +48,53 @@ def test_download_report(mock_cache):
     assert mock_cache.redis.keys("*") == []
 
 
+def test_download_report_chunks(mock_cache, monkeypatch):
+    """
+    Test large archives are downloaded as concurrent chunks when requested
+    """
+    from code_coverage_tools import gcp
+
+    mock_cache.bucket.add_mock_blob("myrepo/deadbeef456/all:all.json.zstd")
+    monkeypatch.setattr(gcp, "DOWNLOAD_CHUNK_SIZE", 4)
+
+    chunked_calls = 0
+
+    def download_chunks_concurrently(blob, path, **kwargs):
+        nonlocal chunked_calls
+        chunked_calls += 1
+        assert kwargs == {
+            "chunk_size": 4,
+            "download_kwargs": {"raw_download": True},
+            "worker_type": "thread",
+            "max_workers": 2,
+        }
+        blob.download_to_filename(path)
+
+    monkeypatch.setattr(
+        gcp, "download_chunks_concurrently", download_chunks_concurrently
+    )
+
+    report = Report(mock_cache.reports_dir, "myrepo", "deadbeef456", date=1, push_id=1)
+
+    # Without max_workers, large archives are still downloaded in one request
+    assert (
+        download_report(mock_cache.reports_dir, mock_cache.bucket, report.name) is True
+    )
+    assert chunked_calls == 0
+    assert json.load(open(report.path)) == {"children": {}, "coveragePercent": 0.0}
+
+    os.unlink(report.path)
+    assert (
+        download_report(
+            mock_cache.reports_dir, mock_cache.bucket, report.name, max_workers=2
+        )
+        is True
+    )
+    assert chunked_calls == 1
+    assert not os.path.exists(report.archive_path)
+    assert json.load(open(report.path)) == {"children": {}, "coveragePercent": 0.0}
+
+
 def test_ingestion(mock_cache):
     """
     Test ingestion of several reports and their retrieval through Redis index
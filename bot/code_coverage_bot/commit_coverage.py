@@ -3,22 +3,38 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import concurrent.futures
 import io
-import json
 import os
 import threading
 import time
+from datetime import datetime
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import hglib
+import ijson
+import orjson
+import simdjson
 import structlog
 import zstandard
+from google.api_core.exceptions import NotFound
+from google.cloud.storage.blob import Blob
+from google.cloud.storage.bucket import Bucket
 from tqdm import tqdm
 
 from code_coverage_bot import hgmo
 from code_coverage_bot.phabricator import PhabricatorUploader
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot.utils import ThreadPoolExecutorResult
+from code_coverage_bot.utils import get_zstd_compressor
+from code_coverage_bot.utils import get_zstd_decompressor
 from code_coverage_tools.gcp import DEFAULT_FILTER
 from code_coverage_tools.gcp import download_report
 from code_coverage_tools.gcp import get_bucket
@@ -27,6 +43,25 @@ from code_coverage_tools.gcp import list_reports
 
 logger = structlog.get_logger(__name__)
 
+Coverage = collections.namedtuple("Coverage", "added, covered, unknown")
+
+# Reports larger than this are streamed, only keeping the coverage of the paths we need.
+# Streaming is about 8 times slower than simdjson and holds the GIL, but simdjson needs
+# about 8 times the size of the report in memory.
+STREAMING_REPORT_SIZE = 256 * 1024 * 1024
+
+# Size of the serialized chunks passed to the compressor when dumping commit coverage.
+DUMP_CHUNK_SIZE = 1024 * 1024
+
+# The commit coverage mapping is stored as a base snapshot, plus one delta per run
+# holding the changesets it analyzed.
+BASE_BLOB = "commit_coverage.json.zst"
+DELTA_PREFIX = "commit_coverage.delta."
+
+# Deltas are merged in the base snapshot once there are more than this (about a week
+# of daily runs).
+COMPACTION_THRESHOLD = 7
+
 hg_servers = list()
 hg_servers_lock = threading.Lock()
 thread_local = threading.local()
@@ -39,6 +74,168 @@ def _init_thread(repo_dir: str) -> None:
         hg_servers.append(hg_server)
 
 
+def _coverage_to_json(obj: Any) -> Dict[str, int]:
+    # Keep publishing the coverage of each changeset as an object.
+    if isinstance(obj, Coverage):
+        return obj._asdict()
+    raise TypeError
+
+
+def _load_report(path: str, paths: Iterable[str]) -> Any:
+    """
+    Load a covdir report, for the lookup of the coverage of the given paths
+    """
+    if os.path.getsize(path) <= STREAMING_REPORT_SIZE:
+        # Parse the report lazily, only building Python objects for the parts of
+        # the tree we look up.
+        # A parser can't be re-used while objects from its previous document are
+        # still alive, so we use a new one for each report.
+        with open(path, "rb") as f:
+            return simdjson.Parser().parse(f.read())
+
+    # Walk large reports in a single pass without loading them, and build a covdir
+    # tree containing only the requested files.
+    coverage_prefixes = {}
+    for file_path in paths:
+        prefix = ".".join(f"children.{part}" for part in file_path.split("/") if part)
+        coverage_prefixes[f"{prefix}.coverage"] = file_path
+        coverage_prefixes[f"{prefix}.coverage.item"] = file_path
+
+    coverage_by_path = {}
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            file_path = coverage_prefixes.get(prefix)
+            if file_path is None:
+                continue
+            if event == "start_array":
+                coverage_by_path[file_path] = []
+            elif event == "number":
+                coverage_by_path[file_path].append(value)
+
+    report: Dict[str, Any] = {"children": {}}
+    for file_path, coverage in coverage_by_path.items():
+        node = report
+        for part in filter(None, file_path.split("/")):
+            node = node["children"].setdefault(part, {"children": {}})
+        node["coverage"] = coverage
+
+    return report
+
+
+def _dump(commit_coverage: Dict[str, Optional[Coverage]], writer: BinaryIO) -> None:
+    """
+    Write commit_coverage as a JSON object, serializing it one entry at a time
+    """
+    chunk = [b"{"]
+    chunk_size = 0
+    for i, (node, coverage) in enumerate(commit_coverage.items()):
+        entry = (
+            (b"," if i > 0 else b"")
+            + orjson.dumps(node)
+            + b":"
+            + orjson.dumps(coverage, default=_coverage_to_json)
+        )
+        chunk.append(entry)
+        chunk_size += len(entry)
+        if chunk_size >= DUMP_CHUNK_SIZE:
+            writer.write(b"".join(chunk))
+            chunk = []
+            chunk_size = 0
+
+    chunk.append(b"}")
+    writer.write(b"".join(chunk))
+
+
+def _load_delta(blob: Blob) -> Dict[str, Optional[Coverage]]:
+    """
+    Download and read the records of a commit coverage delta
+    """
+    delta = {}
+    data = blob.download_as_bytes(raw_download=True)
+    # A delta is made of one zstd frame per batch of records.
+    with get_zstd_decompressor().stream_reader(
+        io.BytesIO(data), read_across_frames=True
+    ) as reader:
+        for line in io.BufferedReader(reader):
+            record = orjson.loads(line)
+            node = record.pop("node")
+            # Changesets without coverage are recorded without any counter.
+            delta[node] = Coverage(**record) if record else None
+    return delta
+
+
+def _load(bucket: Bucket) -> Tuple[Dict[str, Optional[Coverage]], List[Blob]]:
+    """
+    Load the commit coverage mapping from its base snapshot and deltas,
+    also returning the deltas that were merged
+    """
+    blob = bucket.blob(BASE_BLOB)
+    if blob.exists():
+        commit_coverage = {
+            node: Coverage(**coverage) if coverage is not None else None
+            for node, coverage in orjson.loads(
+                get_zstd_decompressor().decompress(
+                    blob.download_as_bytes(raw_download=True)
+                )
+            ).items()
+        }
+    else:
+        commit_coverage = {}
+
+    # Delta names start with the date of their run, so they are merged in order.
+    delta_blobs = sorted(
+        (
+            blob
+            for blob in bucket.list_blobs(prefix=DELTA_PREFIX)
+            if blob.name.endswith(".jsonl.zst")
+        ),
+        key=lambda blob: blob.name,
+    )
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for delta in executor.map(_load_delta, delta_blobs):
+            commit_coverage.update(delta)
+
+    logger.info(
+        f"Loaded {len(commit_coverage)} changesets from {len(delta_blobs)} deltas"
+    )
+
+    return commit_coverage, delta_blobs
+
+
+def _compact(
+    bucket: Bucket,
+    commit_coverage: Dict[str, Optional[Coverage]],
+    delta_blobs: List[Blob],
+) -> None:
+    """
+    Write commit_coverage as the new base snapshot, and remove the deltas it includes
+    """
+    blob = bucket.blob(BASE_BLOB)
+    data = orjson.dumps(commit_coverage, default=_coverage_to_json)
+    blob.content_encoding = "zstd"
+    blob.upload_from_string(
+        get_zstd_compressor(len(data)).compress(data),
+        content_type="application/json",
+    )
+
+    # Deltas created since commit_coverage was loaded are left for the next load.
+    for delta_blob in delta_blobs:
+        try:
+            delta_blob.delete()
+        except NotFound:
+            # Already removed by a concurrent compaction.
+            pass
+
+    logger.info(f"Compacted {len(delta_blobs)} deltas")
+
+
+def _delta_record(node: str, coverage: Optional[Coverage]) -> bytes:
+    record = {"node": node}
+    if coverage is not None:
+        record.update(coverage._asdict())
+    return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+
+
 def generate(
     server_address: str, repo_dir: str, project: str, out_dir: str = "."
 ) -> None:
@@ -51,43 +248,36 @@ def generate(
     ), "Missing GOOGLE_CLOUD_STORAGE secret"
     bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
 
-    blob = bucket.blob("commit_coverage.json.zst")
-    if blob.exists():
-        dctx = zstandard.ZstdDecompressor()
-        commit_coverage = json.loads(
-            dctx.decompress(blob.download_as_bytes(raw_download=True))
-        )
-    else:
-        commit_coverage = {}
+    commit_coverage, delta_blobs = _load(bucket)
 
-    cctx = zstandard.ZstdCompressor(threads=-1)
+    # The changesets analyzed by this run are only written to an append-only delta,
+    # so uploads don't need to serialize the whole mapping again.
+    delta_name = f"{DELTA_PREFIX}{datetime.utcnow():%Y%m%d%H%M%S%f}.jsonl.zst"
+    delta_path = os.path.join(out_dir, delta_name)
+    delta_blob = bucket.blob(delta_name)
+    delta_records = 0
 
-    def _upload():
-        blob = bucket.blob("commit_coverage.json.zst")
-        blob.upload_from_string(
-            cctx.compress(json.dumps(commit_coverage).encode("ascii"))
-        )
-        blob.content_type = "application/json"
-        blob.content_encoding = "zstd"
-        blob.patch()
+    def _upload_delta():
+        delta_blob.content_encoding = "zstd"
+        delta_blob.upload_from_filename(delta_path, content_type="application/x-ndjson")
 
     # We are only interested in "overall" coverage, not platform or suite specific.
-    changesets_to_analyze = [
-        changeset
-        for changeset, platform, suite in list_reports(bucket, project)
-        if platform == DEFAULT_FILTER and suite == DEFAULT_FILTER
-    ]
-
     # Skip already analyzed changesets.
     changesets_to_analyze = [
         changeset
-        for changeset in changesets_to_analyze
-        if changeset not in commit_coverage
+        for changeset, platform, suite in list_reports(bucket, project)
+        if platform == DEFAULT_FILTER
+        and suite == DEFAULT_FILTER
+        and changeset not in commit_coverage
     ]
 
     # Use the local server to generate the coverage mapping, as it is faster and
     # correct.
-    def analyze_changeset(changeset_to_analyze: str) -> None:
+    # The analysis runs in worker threads, the results are merged in commit_coverage
+    # from the main thread.
+    def analyze_changeset(
+        changeset_to_analyze: str,
+    ) -> Dict[str, Optional[Coverage]]:
         report_name = get_name(
             project, changeset_to_analyze, DEFAULT_FILTER, DEFAULT_FILTER
         )
@@ -95,11 +285,6 @@ def generate(
             os.path.join(out_dir, "ccov-reports"), bucket, report_name
         )
 
-        with open(
-            os.path.join(out_dir, "ccov-reports", f"{report_name}.json"), "r"
-        ) as f:
-            report = json.load(f)
-
         phabricatorUploader = PhabricatorUploader(
             repo_dir, changeset_to_analyze, warnings_enabled=False
         )
@@ -111,51 +296,85 @@ def generate(
                 changeset_to_analyze
             )
 
+        # PhabricatorUploader only looks up the coverage of the files touched by
+        # the changesets.
+        report = _load_report(
+            os.path.join(out_dir, "ccov-reports", f"{report_name}.json"),
+            {path for changeset in changesets for path in changeset["files"]},
+        )
+
         results = phabricatorUploader.generate(thread_local.hg, report, changesets)
 
+        changesets_coverage: Dict[str, Optional[Coverage]] = {}
         for changeset in changesets:
             # Lookup changeset coverage from phabricator uploader
             coverage = results.get(changeset["node"])
             if coverage is None:
                 logger.info("No coverage found", changeset=changeset)
-                commit_coverage[changeset["node"]] = None
+                changesets_coverage[changeset["node"]] = None
                 continue
 
-            commit_coverage[changeset["node"]] = {
-                "added": sum(c["lines_added"] for c in coverage["paths"].values()),
-                "covered": sum(c["lines_covered"] for c in coverage["paths"].values()),
-                "unknown": sum(c["lines_unknown"] for c in coverage["paths"].values()),
-            }
+            added = covered = unknown = 0
+            for c in coverage["paths"].values():
+                added += c["lines_added"]
+                covered += c["lines_covered"]
+                unknown += c["lines_unknown"]
+
+            changesets_coverage[changeset["node"]] = Coverage(
+                added=added, covered=covered, unknown=unknown
+            )
+
+        return changesets_coverage
 
     max_workers = min(32, (os.cpu_count() or 1) + 4)
     logger.info(f"Analyzing {len(changesets_to_analyze)} with {max_workers} workers")
 
-    with ThreadPoolExecutorResult(
-        initializer=_init_thread, initargs=(repo_dir,)
-    ) as executor:
-        futures = [
-            executor.submit(analyze_changeset, changeset)
-            for changeset in changesets_to_analyze
-        ]
-        for changeset, future in tqdm(
-            zip(changesets_to_analyze, concurrent.futures.as_completed(futures)),
-            total=len(futures),
-        ):
-            exc = future.exception()
-            if exc is not None:
-                logger.error(f"Exception {exc} while analyzing {changeset}")
-
-            if time.monotonic() - start_time >= 600:
-                _upload()
-                start_time = time.monotonic()
-
-    while len(hg_servers) > 0:
-        hg_server = hg_servers.pop()
-        hg_server.close()
-
-    _upload()
+    try:
+        # Each changeset is written as its own small frame, too small to benefit from
+        # multi-threaded compression.
+        with get_zstd_compressor(0).stream_writer(open(delta_path, "wb")) as delta:
+            with ThreadPoolExecutorResult(
+                max_workers=max_workers, initializer=_init_thread, initargs=(repo_dir,)
+            ) as executor:
+                futures = {
+                    executor.submit(analyze_changeset, changeset): changeset
+                    for changeset in changesets_to_analyze
+                }
+                for future in tqdm(
+                    concurrent.futures.as_completed(futures),
+                    total=len(futures),
+                ):
+                    exc = future.exception()
+                    if exc is not None:
+                        logger.error(
+                            f"Exception {exc} while analyzing {futures[future]}"
+                        )
+                    else:
+                        changesets_coverage = future.result()
+                        commit_coverage.update(changesets_coverage)
+                        for node, coverage in changesets_coverage.items():
+                            delta.write(_delta_record(node, coverage))
+                        delta_records += len(changesets_coverage)
+                        # End the frame, so the delta can be read up to this point.
+                        delta.flush(zstandard.FLUSH_FRAME)
+
+                    if delta_records > 0 and time.monotonic() - start_time >= 600:
+                        _upload_delta()
+                        start_time = time.monotonic()
+
+        while len(hg_servers) > 0:
+            hg_server = hg_servers.pop()
+            hg_server.close()
+
+        if delta_records > 0:
+            _upload_delta()
+            delta_blobs.append(delta_blob)
+    finally:
+        os.remove(delta_path)
+
+    if len(delta_blobs) > COMPACTION_THRESHOLD:
+        _compact(bucket, commit_coverage, delta_blobs)
 
     with open(commit_coverage_path, "wb") as zf:
-        with cctx.stream_writer(zf) as compressor:
-            with io.TextIOWrapper(compressor, encoding="ascii") as f:
-                json.dump(commit_coverage, f)
+        with get_zstd_compressor().stream_writer(zf) as compressor:
+            _dump(commit_coverage, compressor)
@@ -12,9 +12,7 @@ from code_coverage_bot import taskcluster
 from code_coverage_bot import uploader
 from code_coverage_bot.cli import setup_cli
 from code_coverage_bot.hooks.base import Hook
-from code_coverage_bot.secrets import secrets
 from code_coverage_bot.zero_coverage import ZeroCov
-from code_coverage_tools import gcp
 
 logger = structlog.get_logger(__name__)
 
@@ -43,7 +41,7 @@ class CronThunderbirdHook(Hook):
 
     def has_revision_been_processed_before(self, branch, revision):
         """Returns True if the revision is in our storage bucket."""
-        bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+        bucket = uploader.get_gcp_bucket()
         return uploader.gcp_covdir_exists(bucket, branch, revision, "all", "all")
 
     def is_revision_usable(self, namespace, branch, revision):
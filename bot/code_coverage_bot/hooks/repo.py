@@ -20,7 +20,6 @@ from code_coverage_bot.phabricator import PhabricatorUploader
 from code_coverage_bot.phabricator import parse_revision_id
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot.taskcluster import taskcluster_config
-from code_coverage_tools import gcp
 
 logger = structlog.get_logger(__name__)
 
@@ -106,7 +105,7 @@ class MozillaCentralHook(RepositoryHook):
 
     def run(self):
         # Check the covdir report does not already exists
-        bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+        bucket = uploader.get_gcp_bucket()
         if uploader.gcp_covdir_exists(bucket, self.branch, self.revision, "all", "all"):
             logger.warn("Full covdir report already on GCP")
             return
@@ -141,7 +140,7 @@ class MozillaCentralHook(RepositoryHook):
         report = json.loads(report_text)
 
         # Check extensions
-        paths = uploader.covdir_paths(report)
+        paths = list(uploader.covdir_paths(report))
         for extension in [".js", ".cpp"]:
             assert any(
                 path.endswith(extension) for path in paths
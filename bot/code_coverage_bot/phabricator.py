@@ -10,6 +10,7 @@ from typing import Optional
 from typing import Tuple
 
 import hglib
+import simdjson
 import structlog
 from libmozdata.phabricator import BuildState
 from libmozdata.phabricator import PhabricatorAPI
@@ -105,6 +106,10 @@ class PhabricatorUploader(object):
                 return None
             report = report["children"][part]
 
+        # Indexing a lazy simdjson array is linear, materialize it for the lookups.
+        if isinstance(report["coverage"], simdjson.Array):
+            return report["coverage"].as_list()
+
         return report["coverage"]
 
     def _build_coverage_map(self, annotate, coverage_record):
@@ -3,14 +3,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import io
 import os
 from datetime import datetime
 from datetime import timedelta
 
 import requests
 import structlog
-import zstandard
 from taskcluster.utils import slugId
 
 from code_coverage_bot import config
@@ -51,16 +49,16 @@ def trigger_missing(
     triggered_revisions_path = os.path.join(out_dir, "triggered_revisions.zst")
 
     url = f"https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/project.relman.code-coverage.{secrets[secrets.APP_CHANNEL]}.crontrigger.latest/artifacts/public/triggered_revisions.zst"
-    r = requests.head(url, allow_redirects=True)
-    if r.status_code != 404:
+    try:
         utils.download_file(url, triggered_revisions_path)
+    except requests.HTTPError as e:
+        if not utils.is_not_found_error(e):
+            raise
 
     try:
-        dctx = zstandard.ZstdDecompressor()
         with open(triggered_revisions_path, "rb") as zf:
-            with dctx.stream_reader(zf) as reader:
-                with io.TextIOWrapper(reader, encoding="ascii") as f:
-                    triggered_revisions = set(rev for rev in f.read().splitlines())
+            with utils.get_zstd_decompressor().stream_reader(zf) as reader:
+                triggered_revisions = set(reader.read().decode("ascii").splitlines())
     except FileNotFoundError:
         triggered_revisions = set()
 
@@ -129,8 +127,6 @@ def trigger_missing(
         if triggered == MAXIMUM_TRIGGERS:
             break
 
-    cctx = zstandard.ZstdCompressor(threads=-1)
+    data = "\n".join(triggered_revisions).encode("ascii")
     with open(triggered_revisions_path, "wb") as zf:
-        with cctx.stream_writer(zf) as compressor:
-            with io.TextIOWrapper(compressor, encoding="ascii") as f:
-                f.write("\n".join(triggered_revisions))
+        zf.write(utils.get_zstd_compressor(len(data)).compress(data))
@@ -1,48 +1,61 @@
 # -*- coding: utf-8 -*-
-import itertools
-import os.path
+
+import functools
 
 import requests
 import structlog
 import tenacity
-import zstandard as zstd
 from google.cloud.storage.bucket import Bucket
 from requests import HTTPError
 
 from code_coverage_bot.secrets import secrets
+from code_coverage_bot.utils import get_zstd_compressor
+from code_coverage_bot.utils import http_session
 from code_coverage_tools.gcp import get_bucket
 
 logger = structlog.get_logger(__name__)
 GCP_COVDIR_PATH = "{repository}/{revision}/{platform}:{suite}.json.zstd"
+# Fail fast on connection issues, but leave time to the backend to process requests.
+BACKEND_TIMEOUT = (3, 30)
 
 
-def gcp(repository, revision, report, platform, suite):
+@functools.lru_cache(maxsize=None)
+def get_gcp_bucket() -> Bucket:
     """
-    Upload a grcov raw report on Google Cloud Storage
-    * Compress with zstandard
+    Get the Google Cloud Storage bucket configured in the secrets,
+    building the client only once
+    """
+    return get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+
+
+def compress_report(report):
+    """
+    Compress a report with zstandard, so it can be uploaded
+    several times through upload_compressed
+    """
+    assert isinstance(report, bytes)
+    return get_zstd_compressor(len(report)).compress(report)
+
+
+def upload_compressed(archive, repository, revision, platform, suite):
+    """
+    Upload a compressed grcov raw report on Google Cloud Storage
     * Upload on bucket using revision in name
     * Trigger ingestion on channel's backend
     """
-    assert isinstance(report, bytes)
+    assert isinstance(archive, bytes)
     assert isinstance(platform, str)
     assert isinstance(suite, str)
-    bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
-
-    # Compress report
-    compressor = zstd.ZstdCompressor(threads=-1)
-    archive = compressor.compress(report)
+    bucket = get_gcp_bucket()
 
     # Upload archive
     path = GCP_COVDIR_PATH.format(
         repository=repository, revision=revision, platform=platform, suite=suite
     )
     blob = bucket.blob(path)
-    blob.upload_from_string(archive)
-
-    # Update headers
-    blob.content_type = "application/json"
+    # Send the headers along with the archive
     blob.content_encoding = "zstd"
-    blob.patch()
+    blob.upload_from_string(archive, content_type="application/json")
 
     logger.info("Uploaded {} on {}".format(path, bucket))
 
@@ -55,28 +68,35 @@ def gcp(repository, revision, report, platform, suite):
     return blob
 
 
+def gcp(repository, revision, report, platform, suite):
+    """
+    Upload a grcov raw report on Google Cloud Storage
+    * Compress with zstandard
+    * Upload on bucket using revision in name
+    * Trigger ingestion on channel's backend
+    """
+    return upload_compressed(
+        compress_report(report), repository, revision, platform, suite
+    )
+
+
 def gcp_zero_coverage(report):
     """
     Upload a grcov a zero coverage report on Google Cloud Storage
     * Compress with zstandard
     * Upload in the main bucket directory
     """
-    assert isinstance(report, bytes)
-    bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    bucket = get_gcp_bucket()
 
     # Compress report
-    compressor = zstd.ZstdCompressor(threads=-1)
-    archive = compressor.compress(report)
+    archive = compress_report(report)
 
     # Upload archive (this should be in the base directory, because we only care about the latest report)
     path = "zero_coverage_report.json.zstd"
     blob = bucket.blob(path)
-    blob.upload_from_string(archive)
-
-    # Update headers
-    blob.content_type = "application/json"
+    # Send the headers along with the archive
     blob.content_encoding = "zstd"
-    blob.patch()
+    blob.upload_from_string(archive, content_type="application/json")
 
     logger.info("Uploaded {} on {}".format(path, bucket))
 
@@ -96,9 +116,23 @@ def gcp_covdir_exists(
     return blob.exists()
 
 
+def _is_transient_ingestion_error(exception: BaseException) -> bool:
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    if isinstance(exception, HTTPError) and exception.response is not None:
+        # The backend answers with a 404 when it could not retrieve the report yet
+        status = exception.response.status_code
+        return status in (404, 429) or status >= 500
+
+    return False
+
+
 @tenacity.retry(
-    stop=tenacity.stop_after_attempt(10),
-    wait=tenacity.wait_exponential(multiplier=1, min=16, max=64),
+    stop=tenacity.stop_after_attempt(6),
+    wait=tenacity.wait_exponential(multiplier=0.5, min=1, max=30)
+    + tenacity.wait_random(0, 1),
+    retry=tenacity.retry_if_exception(_is_transient_ingestion_error),
     reraise=True,
 )
 def gcp_ingest(repository, revision, platform, suite):
@@ -122,7 +156,9 @@ def gcp_ingest(repository, revision, platform, suite):
         platform=platform,
         suite=suite,
     )
-    resp = requests.get("{}/v2/path".format(backend_host), params=params)
+    resp = http_session.get(
+        "{}/v2/path".format(backend_host), params=params, timeout=BACKEND_TIMEOUT
+    )
     resp.raise_for_status()
     logger.info("Successfully ingested report on backend !")
     return resp
@@ -134,33 +170,29 @@ def gcp_latest(repository):
     """
     params = {"repository": repository}
     backend_host = secrets[secrets.BACKEND_HOST]
-    resp = requests.get("{}/v2/latest".format(backend_host), params=params)
+    resp = http_session.get(
+        "{}/v2/latest".format(backend_host), params=params, timeout=BACKEND_TIMEOUT
+    )
     resp.raise_for_status()
     return resp.json()
 
 
 def covdir_paths(report):
     """
-    Load a covdir report and recursively list all the paths
+    Load a covdir report and list all the paths, walking the tree depth first
     """
     assert isinstance(report, dict)
 
-    def _extract(obj, base_path=""):
-        out = []
-        children = obj.get("children", {})
+    stack = [(report, "")]
+    while stack:
+        obj, base_path = stack.pop()
+        # Covdir paths are relative POSIX paths, no need for os.path.join
+        path = f"{base_path}/{obj['name']}" if base_path else obj["name"]
+        children = obj.get("children")
         if children:
-            # Recursive on folder files
-            out += itertools.chain(
-                *[
-                    _extract(child, os.path.join(base_path, obj["name"]))
-                    for child in children.values()
-                ]
-            )
+            # Walk folder files, in the report order
+            stack.extend((child, path) for child in reversed(children.values()))
 
         else:
             # Add full filename
-            out.append(os.path.join(base_path, obj["name"]))
-
-        return out
-
-    return _extract(report)
+            yield path
@@ -4,15 +4,30 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import concurrent.futures
 import subprocess
+import threading
 from zipfile import BadZipFile
 from zipfile import is_zipfile
 
 import requests
 import structlog
 import tenacity
+import zstandard
+from requests.adapters import HTTPAdapter
 
 log = structlog.get_logger(__name__)
 
+ZSTD_LEVEL = 3
+ZSTD_THREADS = 8
+# Below this size, multi-threaded compression costs more than it saves.
+ZSTD_MULTITHREAD_MIN_SIZE = 256 * 1024
+
+# Share HTTP connections between all the requests made by the bot.
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+# zstandard contexts can't be shared between threads, so they are cached per thread.
+zstd_thread_local = threading.local()
+
 
 def hide_secrets(text, secrets):
     if type(text) is bytes:
@@ -89,14 +104,27 @@ class ThreadPoolExecutorResult(concurrent.futures.ThreadPoolExecutor):
         return super(ThreadPoolExecutorResult, self).__exit__(*args)
 
 
+def is_not_found_error(exception: BaseException) -> bool:
+    return (
+        isinstance(exception, requests.HTTPError)
+        and exception.response is not None
+        and exception.response.status_code == 404
+    )
+
+
 def download_file(url: str, path: str) -> None:
+    """
+    Download a file, raising a requests.HTTPError if it can't be found
+    """
+
     @tenacity.retry(
         reraise=True,
         wait=tenacity.wait_exponential(multiplier=1, min=16, max=64),
         stop=tenacity.stop_after_attempt(5),
+        retry=tenacity.retry_if_exception(lambda e: not is_not_found_error(e)),
     )
     def perform_download() -> None:
-        r = requests.get(url, stream=True)
+        r = http_session.get(url, stream=True)
         r.raise_for_status()
 
         with open(path, "wb") as f:
@@ -107,3 +135,28 @@ def download_file(url: str, path: str) -> None:
             raise BadZipFile("File is not a zip file")
 
     perform_download()
+
+
+def get_zstd_compressor(size: int = -1) -> zstandard.ZstdCompressor:
+    """
+    Get a zstandard compressor for an input of the given size (-1 if unknown),
+    re-used across calls in the current thread
+    """
+    if not hasattr(zstd_thread_local, "compressors"):
+        zstd_thread_local.compressors = {}
+
+    threads = ZSTD_THREADS if size < 0 or size >= ZSTD_MULTITHREAD_MIN_SIZE else 0
+    if threads not in zstd_thread_local.compressors:
+        zstd_thread_local.compressors[threads] = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, threads=threads
+        )
+    return zstd_thread_local.compressors[threads]
+
+
+def get_zstd_decompressor() -> zstandard.ZstdDecompressor:
+    """
+    Get a zstandard decompressor, re-used across calls in the current thread
+    """
+    if not hasattr(zstd_thread_local, "decompressor"):
+        zstd_thread_local.decompressor = zstandard.ZstdDecompressor()
+    return zstd_thread_local.decompressor
@@ -5,6 +5,7 @@ import threading
 from contextlib import contextmanager
 
 import zstandard
+from google.api_core.exceptions import NotFound
 
 from code_coverage_bot import commit_coverage
 from code_coverage_bot import hgmo
@@ -14,6 +15,13 @@ from conftest import copy_pushlog_database
 from conftest import covdir_report
 
 
+def read_delta(data):
+    dctx = zstandard.ZstdDecompressor()
+    with dctx.stream_reader(data, read_across_frames=True) as reader:
+        records = [json.loads(line) for line in reader.read().splitlines()]
+    return {record.pop("node"): record or None for record in records}
+
+
 def test_generate_from_scratch(
     monkeypatch, tmpdir, mock_secrets, mock_taskcluster, mock_phabricator, fake_hg_repo
 ):
@@ -40,29 +48,49 @@ def test_generate_from_scratch(
     )
 
     uploaded_data = None
-    patch_calls = 0
+    upload_calls = 0
+    delta_data = None
+    deleted = []
 
     class Blob:
+        def __init__(self, path):
+            self.path = path
+            self.content_encoding = None
+
         def exists(self):
             return False
 
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
+        def upload_from_string(self, val, content_type=None):
+            nonlocal uploaded_data, upload_calls
+            assert content_type == "application/json"
+            assert self.content_encoding == "zstd"
             uploaded_data = val
+            upload_calls += 1
+
+        def upload_from_filename(self, path, content_type=None):
+            nonlocal delta_data
+            assert self.path.startswith("commit_coverage.delta.")
+            assert content_type == "application/x-ndjson"
+            assert self.content_encoding == "zstd"
+            with open(path, "rb") as f:
+                delta_data = f.read()
+
+        def delete(self):
+            deleted.append(self.path)
 
         def download_as_bytes(self, raw_download=False):
             assert False
 
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
     class Bucket:
         def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
+            assert path == "commit_coverage.json.zst" or path.startswith(
+                "commit_coverage.delta."
+            )
+            return Blob(path)
+
+        def list_blobs(self, prefix):
+            assert prefix == "commit_coverage.delta."
+            return []
 
     myBucket = Bucket()
 
@@ -97,10 +125,14 @@ def test_generate_from_scratch(
 
     monkeypatch.setattr(commit_coverage, "download_report", download_report)
 
+    # Merge the delta of this run in the base snapshot right away.
+    monkeypatch.setattr(commit_coverage, "COMPACTION_THRESHOLD", 0)
+
     with hgmo.HGMO(repo_dir=local) as hgmo_server:
         commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
 
-    assert patch_calls == 1
+    assert upload_calls == 1
+    assert len(deleted) == 1 and deleted[0].startswith("commit_coverage.delta.")
 
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
@@ -108,6 +140,7 @@ def test_generate_from_scratch(
             result = json.load(reader)
 
     assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == read_delta(delta_data)
     assert result == {
         revision1: {
             "added": 3,
@@ -165,29 +198,49 @@ def test_generate_two_pushes(
     )
 
     uploaded_data = None
-    patch_calls = 0
+    upload_calls = 0
+    delta_data = None
+    deleted = []
 
     class Blob:
+        def __init__(self, path):
+            self.path = path
+            self.content_encoding = None
+
         def exists(self):
             return False
 
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
+        def upload_from_string(self, val, content_type=None):
+            nonlocal uploaded_data, upload_calls
+            assert content_type == "application/json"
+            assert self.content_encoding == "zstd"
             uploaded_data = val
+            upload_calls += 1
+
+        def upload_from_filename(self, path, content_type=None):
+            nonlocal delta_data
+            assert self.path.startswith("commit_coverage.delta.")
+            assert content_type == "application/x-ndjson"
+            assert self.content_encoding == "zstd"
+            with open(path, "rb") as f:
+                delta_data = f.read()
+
+        def delete(self):
+            deleted.append(self.path)
 
         def download_as_bytes(self, raw_download=False):
             assert False
 
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
     class Bucket:
         def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
+            assert path == "commit_coverage.json.zst" or path.startswith(
+                "commit_coverage.delta."
+            )
+            return Blob(path)
+
+        def list_blobs(self, prefix):
+            assert prefix == "commit_coverage.delta."
+            return []
 
     myBucket = Bucket()
 
@@ -254,14 +307,15 @@ def test_generate_two_pushes(
 
         commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
 
-    assert patch_calls == 1
+    assert upload_calls == 0
+    assert deleted == []
 
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
         with dctx.stream_reader(zf) as reader:
             result = json.load(reader)
 
-    assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == read_delta(delta_data)
     assert result == {
         revision1: {
             "added": 3,
@@ -312,15 +366,35 @@ def test_generate_from_preexisting(
     )
 
     uploaded_data = None
-    patch_calls = 0
+    upload_calls = 0
+    delta_data = None
+    deleted = []
 
     class Blob:
+        def __init__(self, path):
+            self.path = path
+            self.content_encoding = None
+
         def exists(self):
-            return True
+            return self.path == "commit_coverage.json.zst"
 
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
+        def upload_from_string(self, val, content_type=None):
+            nonlocal uploaded_data, upload_calls
+            assert content_type == "application/json"
+            assert self.content_encoding == "zstd"
             uploaded_data = val
+            upload_calls += 1
+
+        def upload_from_filename(self, path, content_type=None):
+            nonlocal delta_data
+            assert self.path.startswith("commit_coverage.delta.")
+            assert content_type == "application/x-ndjson"
+            assert self.content_encoding == "zstd"
+            with open(path, "rb") as f:
+                delta_data = f.read()
+
+        def delete(self):
+            deleted.append(self.path)
 
         def download_as_bytes(self, raw_download=False):
             return zstandard.ZstdCompressor().compress(
@@ -336,16 +410,16 @@ def test_generate_from_preexisting(
                 ).encode("ascii")
             )
 
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
     class Bucket:
         def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
+            assert path == "commit_coverage.json.zst" or path.startswith(
+                "commit_coverage.delta."
+            )
+            return Blob(path)
+
+        def list_blobs(self, prefix):
+            assert prefix == "commit_coverage.delta."
+            return []
 
     myBucket = Bucket()
 
@@ -383,14 +457,19 @@ def test_generate_from_preexisting(
     with hgmo.HGMO(repo_dir=local) as hgmo_server:
         commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
 
-    assert patch_calls == 1
+    assert upload_calls == 0
+    assert deleted == []
 
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
         with dctx.stream_reader(zf) as reader:
             result = json.load(reader)
 
-    assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == {
+        "revision1": {"added": 7, "covered": 3, "unknown": 0},
+        "revision2": None,
+        **read_delta(delta_data),
+    }
     assert result == {
         "revision1": {"added": 7, "covered": 3, "unknown": 0},
         "revision2": None,
@@ -405,3 +484,164 @@ def test_generate_from_preexisting(
             "unknown": 0,
         },
     }
+
+
+def test_load_report_streaming(monkeypatch, tmpdir):
+    report = covdir_report(
+        {
+            "source_files": [
+                {"name": "file", "coverage": [None, 0, 1, 1]},
+                {"name": "other", "coverage": [2, None]},
+            ]
+        }
+    )
+    path = os.path.join(tmpdir.strpath, "report.json")
+    with open(path, "w") as f:
+        json.dump(report, f)
+
+    in_memory = commit_coverage._load_report(path, {"file", "missing"})
+    assert list(in_memory["children"]["file"]["coverage"]) == [-1, 0, 1, 1]
+
+    monkeypatch.setattr(commit_coverage, "STREAMING_REPORT_SIZE", 0)
+    assert commit_coverage._load_report(path, {"file", "missing"}) == {
+        "children": {"file": {"children": {}, "coverage": [-1, 0, 1, 1]}}
+    }
+
+
+def test_generate_from_deltas(monkeypatch, tmpdir, mock_secrets):
+    tmp_path = tmpdir.strpath
+
+    def compress(*records):
+        cctx = zstandard.ZstdCompressor()
+        # One frame per record, as written by generate.
+        return b"".join(
+            cctx.compress(json.dumps(record).encode("ascii") + b"\n")
+            for record in records
+        )
+
+    contents = {
+        "commit_coverage.json.zst": zstandard.ZstdCompressor().compress(
+            json.dumps(
+                {
+                    "revision1": {"added": 7, "covered": 3, "unknown": 0},
+                    "revision2": None,
+                    "revision3": {"added": 1, "covered": 1, "unknown": 0},
+                }
+            ).encode("ascii")
+        ),
+        "commit_coverage.delta.20200101000000000000.jsonl.zst": compress(
+            {"node": "revision2", "added": 2, "covered": 1, "unknown": 1},
+            {"node": "revision4"},
+        ),
+        "commit_coverage.delta.20200102000000000000.jsonl.zst": compress(
+            {"node": "revision3"},
+            {"node": "revision4", "added": 4, "covered": 2, "unknown": 0},
+        ),
+    }
+    uploaded_data = None
+    deleted = []
+
+    class Blob:
+        def __init__(self, name):
+            self.name = name
+            self.content_encoding = None
+
+        def exists(self):
+            return self.name in contents
+
+        def download_as_bytes(self, raw_download=False):
+            assert raw_download
+            return contents[self.name]
+
+        def upload_from_string(self, val, content_type=None):
+            nonlocal uploaded_data
+            assert self.name == "commit_coverage.json.zst"
+            assert content_type == "application/json"
+            assert self.content_encoding == "zstd"
+            uploaded_data = val
+
+        def upload_from_filename(self, path, content_type=None):
+            # Nothing new was analyzed.
+            assert False
+
+        def delete(self):
+            deleted.append(self.name)
+            # Simulate a concurrent compaction having already removed it.
+            if self.name.endswith("20200101000000000000.jsonl.zst"):
+                raise NotFound("Already deleted")
+
+    class Bucket:
+        def blob(self, name):
+            return Blob(name)
+
+        def list_blobs(self, prefix):
+            assert prefix == "commit_coverage.delta."
+            # The listing order is not relied upon.
+            return [
+                Blob(name)
+                for name in sorted(contents, reverse=True)
+                if name.startswith(prefix)
+            ]
+
+    monkeypatch.setattr(commit_coverage, "get_bucket", lambda acc: Bucket())
+
+    def list_reports(bucket, repo):
+        yield "revision1", "all", "all"
+        yield "revision4", "all", "all"
+
+    monkeypatch.setattr(commit_coverage, "list_reports", list_reports)
+    monkeypatch.setattr(commit_coverage, "COMPACTION_THRESHOLD", 1)
+
+    commit_coverage.generate(
+        "https://hg.mozilla.org/", "repo", "mozilla-central", out_dir=tmp_path
+    )
+
+    dctx = zstandard.ZstdDecompressor()
+    with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
+        with dctx.stream_reader(zf) as reader:
+            result = json.load(reader)
+
+    # Later deltas override earlier ones and the base snapshot.
+    assert result == {
+        "revision1": {"added": 7, "covered": 3, "unknown": 0},
+        "revision2": {"added": 2, "covered": 1, "unknown": 1},
+        "revision3": None,
+        "revision4": {"added": 4, "covered": 2, "unknown": 0},
+    }
+    assert json.loads(dctx.decompress(uploaded_data)) == result
+    assert sorted(deleted) == [
+        "commit_coverage.delta.20200101000000000000.jsonl.zst",
+        "commit_coverage.delta.20200102000000000000.jsonl.zst",
+    ]
+    assert os.listdir(tmp_path) == ["commit_coverage.json.zst"]
+
+
+def test_load_delta_checkpoint(tmpdir):
+    path = os.path.join(tmpdir.strpath, "delta.jsonl.zst")
+
+    class Blob:
+        def download_as_bytes(self, raw_download=False):
+            with open(path, "rb") as f:
+                return f.read()
+
+    cctx = zstandard.ZstdCompressor()
+    with cctx.stream_writer(open(path, "wb")) as delta:
+        delta.write(
+            commit_coverage._delta_record(
+                "revision1", commit_coverage.Coverage(added=3, covered=2, unknown=0)
+            )
+        )
+        delta.flush(zstandard.FLUSH_FRAME)
+
+        # A checkpoint uploaded in the middle of a run can be loaded.
+        assert commit_coverage._load_delta(Blob()) == {
+            "revision1": commit_coverage.Coverage(added=3, covered=2, unknown=0)
+        }
+
+        delta.write(commit_coverage._delta_record("revision2", None))
+        delta.flush(zstandard.FLUSH_FRAME)
+
+    assert commit_coverage._load_delta(Blob()) == {
+        "revision1": commit_coverage.Coverage(added=3, covered=2, unknown=0),
+        "revision2": None,
+    }
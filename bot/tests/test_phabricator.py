@@ -6,6 +6,7 @@ import urllib.parse
 
 import hglib
 import responses
+import simdjson
 
 from code_coverage_bot import hgmo
 from code_coverage_bot.phabricator import PhabricatorUploader
@@ -578,6 +579,53 @@ def test_coverable_last_lines(mock_secrets, mock_phabricator, fake_hg_repo):
     }
 
 
+def test_simdjson_report(mock_secrets, fake_hg_repo):
+    hg, local, remote = fake_hg_repo
+
+    add_file(hg, local, "file", "1\n2\n3\n4\n5\n6\n7\n")
+    revision = commit(hg, 1)
+
+    hg.push(dest=bytes(remote, "ascii"))
+
+    copy_pushlog_database(remote, local)
+
+    phabricator = PhabricatorUploader(local, revision)
+    report = simdjson.Parser().parse(
+        json.dumps(
+            covdir_report(
+                {
+                    "source_files": [
+                        {"name": "file", "coverage": [None, 0, 1, 1, 1, 1, 0]}
+                    ]
+                }
+            )
+        ).encode("ascii")
+    )
+
+    # Lazy arrays are converted, as indexing them is linear.
+    assert isinstance(phabricator._find_coverage(report, "file"), list)
+
+    with hgmo.HGMO(local) as hgmo_server:
+        stack = changesets(hgmo_server, revision)
+
+    with hglib.open(local) as hg:
+        results = phabricator.generate(hg, report, stack)
+
+    assert results == {
+        revision: {
+            "revision_id": 1,
+            "paths": {
+                "file": {
+                    "coverage": "NUCCCCU",
+                    "lines_added": 6,
+                    "lines_covered": 4,
+                    "lines_unknown": 0,
+                }
+            },
+        }
+    }
+
+
 def test_third_party(mock_secrets, fake_hg_repo):
     hg, local, remote = fake_hg_repo
 
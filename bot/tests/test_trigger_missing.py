@@ -21,7 +21,7 @@ def test_trigger_from_scratch(
     tmp_path = tmpdir.strpath
 
     responses.add(
-        responses.HEAD,
+        responses.GET,
         "https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/project.relman.code-coverage.production.crontrigger.latest/artifacts/public/triggered_revisions.zst",
         status=404,
     )
@@ -231,12 +231,6 @@ def test_trigger_from_preexisting(
 
     hg.push(dest=bytes(remote, "ascii"))
 
-    responses.add(
-        responses.HEAD,
-        "https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/project.relman.code-coverage.production.crontrigger.latest/artifacts/public/triggered_revisions.zst",
-        status=200,
-    )
-
     responses.add(
         responses.GET,
         "https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/project.relman.code-coverage.production.crontrigger.latest/artifacts/public/triggered_revisions.zst",
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+import responses
+import tenacity
+import zstandard
+
+from code_coverage_bot import uploader
+from code_coverage_bot.secrets import secrets
+from conftest import covdir_report
+
+
+def test_get_gcp_bucket(monkeypatch, mock_secrets):
+    calls = 0
+    myBucket = object()
+
+    def get_bucket(acc):
+        nonlocal calls
+        calls += 1
+        assert acc == {}
+        return myBucket
+
+    monkeypatch.setattr(uploader, "get_bucket", get_bucket)
+    uploader.get_gcp_bucket.cache_clear()
+
+    assert uploader.get_gcp_bucket() is myBucket
+    assert uploader.get_gcp_bucket() is myBucket
+    assert calls == 1
+
+    uploader.get_gcp_bucket.cache_clear()
+
+
+def test_gcp(monkeypatch, mock_secrets):
+    uploads = []
+
+    class Blob:
+        def __init__(self, path):
+            self.path = path
+            self.content_encoding = None
+
+        def upload_from_string(self, val, content_type=None):
+            assert content_type == "application/json"
+            assert self.content_encoding == "zstd"
+            uploads.append((self.path, val))
+
+        def patch(self):
+            assert False
+
+    class Bucket:
+        def blob(self, path):
+            return Blob(path)
+
+    monkeypatch.setattr(uploader, "get_gcp_bucket", lambda: Bucket())
+
+    ingested = []
+
+    def gcp_ingest(repository, revision, platform, suite):
+        ingested.append((repository, revision, platform, suite))
+
+    monkeypatch.setattr(uploader, "gcp_ingest", gcp_ingest)
+
+    report = b'{"children": {}}'
+    uploader.gcp("mozilla-central", "abcdef", report, "linux", "all")
+
+    assert len(uploads) == 1
+    path, archive = uploads[0]
+    assert path == "mozilla-central/abcdef/linux:all.json.zstd"
+    assert zstandard.ZstdDecompressor().decompress(archive) == report
+    assert ingested == [("mozilla-central", "abcdef", "linux", "all")]
+
+
+def test_gcp_covdir_exists():
+    class Blob:
+        def __init__(self, name):
+            self.name = name
+
+        def exists(self):
+            return self.name == "mozilla-central/abcdef/all:all.json.zstd"
+
+    class Bucket:
+        def blob(self, name):
+            return Blob(name)
+
+    bucket = Bucket()
+
+    assert uploader.gcp_covdir_exists(bucket, "mozilla-central", "abcdef", "all", "all")
+    assert not uploader.gcp_covdir_exists(
+        bucket, "mozilla-central", "abcdef", "linux", "all"
+    )
+
+
+def test_gcp_ingest(monkeypatch, mock_secrets):
+    monkeypatch.setitem(secrets, secrets.BACKEND_HOST, "https://backend.test")
+
+    responses.add(
+        responses.GET,
+        "https://backend.test/v2/path?repository=mozilla-central&changeset=abcdef&platform=linux&suite=all",
+        json={"path": ""},
+        match_querystring=True,
+    )
+
+    resp = uploader.gcp_ingest("mozilla-central", "abcdef", "linux", "all")
+    assert resp.json() == {"path": ""}
+
+
+@pytest.mark.parametrize("status, calls", [(500, 6), (404, 6), (400, 1), (403, 1)])
+def test_gcp_ingest_retries(monkeypatch, mock_secrets, status, calls):
+    monkeypatch.setitem(secrets, secrets.BACKEND_HOST, "https://backend.test")
+    monkeypatch.setattr(uploader.gcp_ingest.retry, "wait", tenacity.wait_none())
+
+    responses.add(responses.GET, "https://backend.test/v2/path", status=status)
+
+    with pytest.raises(requests.HTTPError):
+        uploader.gcp_ingest("mozilla-central", "abcdef", "all", "all")
+    assert len(responses.calls) == calls
+
+
+def test_covdir_paths():
+    report = {
+        "name": "",
+        "children": {
+            "dom": {
+                "name": "dom",
+                "children": {
+                    "file.cpp": {"name": "file.cpp", "children": {}, "coverage": []},
+                    "file.h": {"name": "file.h", "coverage": []},
+                },
+            },
+            "js": {
+                "name": "js",
+                "children": {
+                    "src": {
+                        "name": "src",
+                        "children": {"file.js": {"name": "file.js", "coverage": []}},
+                    }
+                },
+            },
+            "README": {"name": "README", "coverage": []},
+        },
+    }
+
+    assert list(uploader.covdir_paths(report)) == [
+        "dom/file.cpp",
+        "dom/file.h",
+        "js/src/file.js",
+        "README",
+    ]
+
+
+def test_covdir_paths_root_name():
+    report = covdir_report(
+        {
+            "source_files": [
+                {"name": "file1", "coverage": [None, 1, 0]},
+                {"name": "file2", "coverage": [1]},
+            ]
+        }
+    )
+
+    assert list(uploader.covdir_paths(report)) == ["src/file1", "src/file2"]
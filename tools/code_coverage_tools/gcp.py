@@ -11,12 +11,19 @@ import pytz
 import structlog
 import zstandard
 from google.cloud import storage as gcp_storage
+from google.cloud.storage.transfer_manager import THREAD
+from google.cloud.storage.transfer_manager import download_chunks_concurrently
 from google.oauth2.service_account import Credentials
 
 logger = structlog.get_logger(__name__)
 
 DEFAULT_FILTER = "all"
 
+# Archives larger than a chunk can be downloaded as concurrent byte ranges
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# The storage client pools up to 10 connections, stay below that
+DOWNLOAD_WORKERS = 8
+
 
 def get_bucket(service_account: dict) -> gcp_storage.bucket.Bucket:
     """
@@ -41,15 +48,23 @@ def get_name(repository: str, changeset: str, platform: str, suite: str) -> str:
 
 
 def download_report(
-    base_dir: str, bucket: gcp_storage.bucket.Bucket, name: str
+    base_dir: str,
+    bucket: gcp_storage.bucket.Bucket,
+    name: str,
+    max_workers: Optional[int] = None,
 ) -> bool:
+    """
+    Download a report archive and decompress it in base_dir
+    Large archives are downloaded in chunks by max_workers threads, which
+    should only be set by callers that don't already download in parallel
+    """
     path = f"{name}.json"
     archive_path = f"{name}.json.zstd"
     full_archive_path = os.path.join(base_dir, archive_path)
     full_path = os.path.join(base_dir, path)
 
-    blob = bucket.blob(archive_path)
-    if not blob.exists():
+    blob = bucket.get_blob(archive_path)
+    if blob is None:
         logger.debug("No report found on GCP", path=archive_path)
         return False
 
@@ -58,7 +73,18 @@ def download_report(
         return True
 
     os.makedirs(os.path.dirname(full_archive_path), exist_ok=True)
-    blob.download_to_filename(full_archive_path, raw_download=True)
+    if max_workers is not None and blob.size > DOWNLOAD_CHUNK_SIZE:
+        # Threads share the client's connection pool, unlike processes
+        download_chunks_concurrently(
+            blob,
+            full_archive_path,
+            chunk_size=DOWNLOAD_CHUNK_SIZE,
+            download_kwargs={"raw_download": True},
+            worker_type=THREAD,
+            max_workers=max_workers,
+        )
+    else:
+        blob.download_to_filename(full_archive_path, raw_download=True)
     logger.info("Downloaded report archive", path=full_archive_path)
 
     with open(full_path, "wb") as output: